@@ -2,7 +2,6 @@ from functools import partial
 from pathlib import Path
 
 import hydra
-import mlflow
 import numpy as np
 import torch
 import torch.distributed as dist
@@ -14,11 +13,13 @@ from nnsvs.multistream import split_streams
 from nnsvs.train_util import (
     collate_fn_default,
     collate_fn_random_segments,
+    get_local_rank,
     get_stream_weight,
     log_params_from_omegaconf_dict,
     save_checkpoint,
     save_configs,
     setup,
+    wait_for_checkpoints,
 )
 from nnsvs.util import PyTorchStandardScaler, make_non_pad_mask
 from omegaconf import DictConfig
@@ -98,7 +99,7 @@ def train_step(
         loss = loss.masked_select(mask_).mean()
     else:
         if stream_wise_loss:
-            w = get_stream_weight(stream_weights, stream_sizes).to(in_feats.device)
+            w = get_stream_weight(stream_weights, stream_sizes, in_feats.device)
             streams = split_streams(out_feats, stream_sizes)
             pred_streams = split_streams(pred_out_feats, stream_sizes)
             loss = 0
@@ -149,6 +150,9 @@ def train_loop(
     out_scaler,
     use_mlflow,
 ):
+    if use_mlflow:
+        import mlflow
+
     out_dir = Path(to_absolute_path(config.train.out_dir))
     best_dev_loss = torch.finfo(torch.float32).max
     last_dev_loss = torch.finfo(torch.float32).max
@@ -181,11 +185,10 @@ def train_loop(
             for in_feats, out_feats, lengths in tqdm(
                 data_loaders[phase], desc=f"{phase} iter", leave=False
             ):
-                # NOTE: This is needed for pytorch's PackedSequence
-                lengths, indices = torch.sort(lengths, dim=0, descending=True)
+                # NOTE: mini-batches are already sorted by length in collate_fn
                 in_feats, out_feats = (
-                    in_feats[indices].to(device),
-                    out_feats[indices].to(device),
+                    in_feats.to(device, non_blocking=True),
+                    out_feats.to(device, non_blocking=True),
                 )
                 loss, log_metrics = train_step(
                     model=model,
@@ -252,6 +255,7 @@ def train_loop(
     save_checkpoint(
         logger, out_dir, model, optimizer, lr_scheduler, config.train.nepochs
     )
+    wait_for_checkpoints()
     logger.info("The best loss was %s", best_dev_loss)
     if use_mlflow:
         mlflow.log_metric("best_dev_loss", best_dev_loss, step=epoch)
@@ -271,9 +275,7 @@ def my_app(config: DictConfig) -> None:
 
     if config.train.use_ddp:
         dist.init_process_group("nccl")
-        rank = dist.get_rank()
-        device_id = rank % torch.cuda.device_count()
-        torch.cuda.set_device(device_id)
+        torch.cuda.set_device(get_local_rank())
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     (
@@ -295,6 +297,8 @@ def my_app(config: DictConfig) -> None:
     use_mlflow = config.mlflow.enabled
 
     if use_mlflow:
+        import mlflow
+
         with mlflow.start_run() as run:
             # NOTE: modify out_dir when running with mlflow
             config.train.out_dir = f"{config.train.out_dir}/{run.info.run_id}"
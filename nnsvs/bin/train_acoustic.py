@@ -2,7 +2,6 @@ from functools import partial
 from pathlib import Path
 
 import hydra
-import mlflow
 import torch
 import torch.distributed as dist
 from hydra.utils import to_absolute_path
@@ -16,12 +15,14 @@ from nnsvs.train_util import (
     compute_batch_pitch_regularization_weight,
     compute_distortions,
     eval_model,
+    get_local_rank,
     get_stream_weight,
     load_vocoder,
     log_params_from_omegaconf_dict,
     save_checkpoint,
     save_configs,
     setup,
+    wait_for_checkpoints,
 )
 from nnsvs.util import PyTorchStandardScaler, make_non_pad_mask, make_pad_mask
 from omegaconf import DictConfig
@@ -83,8 +84,8 @@ def train_step(
         streams = split_streams(out_feats, model_config.stream_sizes)
         assert len(streams) == len(pred_out_feats)
         if stream_wise_loss:
-            weights = get_stream_weight(stream_weights, model_config.stream_sizes).to(
-                in_feats.device
+            weights = get_stream_weight(
+                stream_weights, model_config.stream_sizes, in_feats.device
             )
         else:
             weights = [None] * len(streams)
@@ -138,8 +139,8 @@ def train_step(
             for pred_out_feats_ in pred_out_feats:
                 if stream_wise_loss:
                     weights = get_stream_weight(
-                        stream_weights, model_config.stream_sizes
-                    ).to(in_feats.device)
+                        stream_weights, model_config.stream_sizes, in_feats.device
+                    )
                     streams = split_streams(out_feats, model_config.stream_sizes)
                     pred_streams = split_streams(
                         pred_out_feats_, model_config.stream_sizes
@@ -268,6 +269,9 @@ def train_loop(
     vocoder_in_scaler=None,
     vocoder_config=None,
 ):
+    if use_mlflow:
+        import mlflow
+
     out_dir = Path(to_absolute_path(config.train.out_dir))
     best_dev_loss = torch.finfo(torch.float32).max
     last_dev_loss = torch.finfo(torch.float32).max
@@ -276,6 +280,11 @@ def train_loop(
     in_rest_idx = config.data.in_rest_idx
     if in_lf0_idx is None or in_rest_idx is None:
         raise ValueError("in_lf0_idx and in_rest_idx must be specified")
+    # NOTE: input features are min-max normalized on disk. Keep the scaler
+    # constants as python floats so that denormalization is done on-device
+    # without converting numpy scalars at every step.
+    in_lf0_min = float(in_scaler.min_[in_lf0_idx])
+    in_lf0_scale = float(in_scaler.scale_[in_lf0_idx])
     pitch_reg_weight = config.train.pitch_reg_weight
 
     if "sample_rate" not in config.data:
@@ -315,20 +324,22 @@ def train_loop(
             for in_feats, out_feats, lengths in tqdm(
                 data_loaders[phase], desc=f"{phase} iter", leave=False
             ):
-                # NOTE: This is needed for pytorch's PackedSequence
-                lengths, indices = torch.sort(lengths, dim=0, descending=True)
+                # NOTE: mini-batches are already sorted by length in collate_fn
                 in_feats, out_feats = (
-                    in_feats[indices].to(device),
-                    out_feats[indices].to(device),
+                    in_feats.to(device, non_blocking=True),
+                    out_feats.to(device, non_blocking=True),
                 )
                 # Compute denormalized log-F0 in the musical scores
                 with torch.no_grad():
                     lf0_score_denorm = (
-                        in_feats[:, :, in_lf0_idx] - in_scaler.min_[in_lf0_idx]
-                    ) / in_scaler.scale_[in_lf0_idx]
+                        in_feats[:, :, in_lf0_idx].sub(in_lf0_min).div_(in_lf0_scale)
+                    )
                     # Fill zeros for rest and padded frames
-                    lf0_score_denorm *= (in_feats[:, :, in_rest_idx] <= 0).float()
-                    lf0_score_denorm[make_pad_mask(lengths)] = 0
+                    lf0_score_denorm.masked_fill_(
+                        (in_feats[:, :, in_rest_idx] > 0)
+                        | make_pad_mask(lengths).to(in_feats.device),
+                        0,
+                    )
 
                     # Compute time-variant pitch regularization weight vector
                     # NOTE: the current impl. is very slow
@@ -424,6 +435,7 @@ def train_loop(
     save_checkpoint(
         logger, out_dir, model, optimizer, lr_scheduler, config.train.nepochs
     )
+    wait_for_checkpoints()
     logger.info("The best loss was %s", best_dev_loss)
     if use_mlflow:
         mlflow.log_metric("best_dev_loss", best_dev_loss, step=epoch)
@@ -449,9 +461,7 @@ def my_app(config: DictConfig) -> None:
 
     if config.train.use_ddp:
         dist.init_process_group("nccl")
-        rank = dist.get_rank()
-        device_id = rank % torch.cuda.device_count()
-        torch.cuda.set_device(device_id)
+        torch.cuda.set_device(get_local_rank())
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -485,6 +495,8 @@ def my_app(config: DictConfig) -> None:
     use_mlflow = config.mlflow.enabled
 
     if use_mlflow:
+        import mlflow
+
         with mlflow.start_run() as run:
             # NOTE: modify out_dir when running with mlflow
             config.train.out_dir = f"{config.train.out_dir}/{run.info.run_id}"
@@ -2,7 +2,6 @@ from functools import partial
 from pathlib import Path
 
 import hydra
-import mlflow
 import numpy as np
 import torch
 import torch.distributed as dist
@@ -13,11 +12,13 @@ from nnsvs.train_util import (
     collate_fn_random_segments,
     compute_distortions,
     eval_model,
+    get_local_rank,
     load_vocoder,
     log_params_from_omegaconf_dict,
     save_checkpoint,
     save_configs,
     setup_gan,
+    wait_for_checkpoints,
 )
 from nnsvs.util import PyTorchStandardScaler, make_non_pad_mask
 from omegaconf import DictConfig
@@ -269,6 +270,9 @@ def train_loop(
     vocoder,
     vocoder_in_scaler,
 ):
+    if use_mlflow:
+        import mlflow
+
     out_dir = Path(to_absolute_path(config.train.out_dir))
     best_dev_loss = torch.finfo(torch.float32).max
     last_dev_loss = torch.finfo(torch.float32).max
@@ -298,11 +302,10 @@ def train_loop(
             for in_feats, out_feats, lengths in tqdm(
                 data_loaders[phase], desc=f"{phase} iter", leave=False
             ):
-                # NOTE: This is needed for pytorch's PackedSequence
-                lengths, indices = torch.sort(lengths, dim=0, descending=True)
+                # NOTE: mini-batches are already sorted by length in collate_fn
                 in_feats, out_feats = (
-                    in_feats[indices].to(device),
-                    out_feats[indices].to(device),
+                    in_feats.to(device, non_blocking=True),
+                    out_feats.to(device, non_blocking=True),
                 )
                 if (not train) and (not evaluated):
                     eval_model(
@@ -423,6 +426,7 @@ def train_loop(
             config.train.nepochs,
             postfix=postfix,
         )
+    wait_for_checkpoints()
     logger.info("The best loss was %s", best_dev_loss)
     if use_mlflow:
         mlflow.log_metric("best_dev_loss", best_dev_loss, step=epoch)
@@ -452,9 +456,7 @@ def my_app(config: DictConfig) -> None:
 
     if config.train.use_ddp:
         dist.init_process_group("nccl")
-        rank = dist.get_rank()
-        device_id = rank % torch.cuda.device_count()
-        torch.cuda.set_device(device_id)
+        torch.cuda.set_device(get_local_rank())
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     (
@@ -482,6 +484,8 @@ def my_app(config: DictConfig) -> None:
     use_mlflow = config.mlflow.enabled
 
     if use_mlflow:
+        import mlflow
+
         with mlflow.start_run() as run:
             # NOTE: modify out_dir when running with mlflow
             config.train.out_dir = f"{config.train.out_dir}/{run.info.run_id}"
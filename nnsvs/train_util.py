@@ -1,11 +1,15 @@
+import inspect
 import os
 import random
 import shutil
 import sys
+import tempfile
 import types
-from glob import glob
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from multiprocessing import Manager
-from os.path import join
+from os.path import basename, exists, join
 from pathlib import Path
 
 import hydra
@@ -13,7 +17,6 @@ import joblib
 import librosa
 import librosa.display
 import matplotlib.pyplot as plt
-import mlflow
 import numpy as np
 import pysptk
 import pyworld
@@ -21,6 +24,7 @@ import torch
 import torch.distributed as dist
 from hydra.utils import get_original_cwd, to_absolute_path
 from nnmnkwii import metrics
+from nnmnkwii.datasets import FileDataSource
 from nnsvs.base import PredictionType
 from nnsvs.gen import gen_world_params
 from nnsvs.logger import getLogger
@@ -34,15 +38,16 @@ from nnsvs.multistream import (
     split_streams,
 )
 from nnsvs.pitch import lowpass_filter, note_segments
-from nnsvs.util import MinMaxScaler, StandardScaler, init_seed, pad_2d
+from nnsvs.util import MinMaxScaler, StandardScaler, init_seed
 from omegaconf import DictConfig, ListConfig, OmegaConf
 from sklearn.preprocessing import MinMaxScaler as SKMinMaxScaler
+from sklearn.preprocessing import StandardScaler as SKStandardScaler
 from torch import nn, optim
 from torch.cuda.amp import GradScaler
 from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.nn.utils.rnn import pad_sequence
 from torch.utils import data as data_utils
 from torch.utils.data.sampler import BatchSampler
-from torch.utils.tensorboard import SummaryWriter
 
 try:
     from parallel_wavegan.utils import load_model
@@ -51,6 +56,19 @@ try:
 except ImportError:
     _pwg_available = False
 
+try:
+    from multiprocessing import shared_memory
+
+    _shared_memory_available = True
+except ImportError:
+    # NOTE: Python 3.7
+    _shared_memory_available = False
+
+# NOTE: persistent_workers and prefetch_factor are available in torch>=1.7
+_dataloader_supports_persistent_workers = (
+    "persistent_workers" in inspect.signature(data_utils.DataLoader).parameters
+)
+
 plt.style.use("seaborn-whitegrid")
 
 
@@ -76,21 +94,103 @@ class ShuffleBatchSampler(BatchSampler):
         return len(self.batches)
 
 
+class LengthGroupedBatchSampler(BatchSampler):
+    """Batch sampler that groups utterances of similar lengths
+
+    Mini-batches are re-built at every epoch. If ``shuffle=True``, lengths are
+    randomly perturbed before sorting so that the utterances grouped together
+    change across epochs, and the order of the mini-batches is shuffled.
+
+    For distributed training, each mini-batch is split across ranks so that every
+    rank gets ``batch_size`` samples. Incomplete mini-batches are padded by
+    repeating samples as :class:`torch.utils.data.DistributedSampler` does.
+
+    Args:
+        lengths (list): Number of frames of the utterances.
+        batch_size (int): Batch size (per rank).
+        shuffle (bool): Whether to shuffle the utterances.
+        noise (float): Relative amount of the noise added to the lengths.
+        num_replicas (int): Number of ranks.
+        rank (int): Rank of the current process.
+        seed (int): Random seed. Must be the same across ranks.
+    """
+
+    def __init__(
+        self,
+        lengths,
+        batch_size,
+        shuffle=True,
+        noise=0.1,
+        num_replicas=1,
+        rank=0,
+        seed=0,
+    ):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.noise = noise
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        lengths = self.lengths.astype(np.float64)
+        if self.shuffle:
+            rng = np.random.RandomState(self.seed + self.epoch)
+            lengths *= rng.uniform(1 - self.noise, 1 + self.noise, len(lengths))
+        # NOTE: increment the epoch in case set_epoch is not called
+        self.epoch += 1
+        indices = np.argsort(lengths, kind="mergesort").tolist()
+
+        global_batch_size = self.batch_size * self.num_replicas
+        batches = [
+            indices[i : i + global_batch_size]
+            for i in range(0, len(indices), global_batch_size)
+        ]
+        if self.shuffle:
+            rng.shuffle(batches)
+
+        for batch in batches:
+            if self.num_replicas > 1:
+                size = int(np.ceil(len(batch) / self.num_replicas)) * self.num_replicas
+                batch = (batch * self.num_replicas)[:size][
+                    self.rank :: self.num_replicas
+                ]
+            yield batch
+
+    def __len__(self):
+        return int(np.ceil(len(self.lengths) / (self.batch_size * self.num_replicas)))
+
+
 def log_params_from_omegaconf_dict(params):
+    import mlflow
+
+    flat = {}
     for param_name, element in params.items():
-        _explore_recursive(param_name, element)
+        _explore_recursive(param_name, element, flat)
+
+    # NOTE: log params in batches rather than one by one to reduce the number of
+    # writes to the tracking store. Older mlflow rejects more than 100 params
+    # in a single batch.
+    keys = list(flat.keys())
+    for i in range(0, len(keys), 100):
+        mlflow.log_params({k: flat[k] for k in keys[i : i + 100]})
 
 
-def _explore_recursive(parent_name, element):
+def _explore_recursive(parent_name, element, flat):
     if isinstance(element, DictConfig):
         for k, v in element.items():
             if isinstance(v, DictConfig) or isinstance(v, ListConfig):
-                _explore_recursive(f"{parent_name}.{k}", v)
+                _explore_recursive(f"{parent_name}.{k}", v, flat)
             else:
-                mlflow.log_param(f"{parent_name}.{k}", v)
+                flat[f"{parent_name}.{k}"] = v
     elif isinstance(element, ListConfig):
         for i, v in enumerate(element):
-            mlflow.log_param(f"{parent_name}.{i}", v)
+            flat[f"{parent_name}.{i}"] = v
 
 
 def num_trainable_params(model):
@@ -102,8 +202,97 @@ def num_trainable_params(model):
     Returns:
         int: Number of trainable parameters.
     """
-    parameters = filter(lambda p: p.requires_grad, model.parameters())
-    return sum([np.prod(p.size()) for p in parameters])
+    return sum(p.numel() for p in model.parameters() if p.requires_grad)
+
+
+def get_num_frames(path):
+    """Get the number of frames of a .npy file without loading the data.
+
+    Only the header of the file is read.
+
+    Args:
+        path (str): Path to the .npy file.
+
+    Returns:
+        int: Number of frames (i.e., size of the first axis).
+    """
+    with open(path, "rb") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, _, _ = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, _, _ = np.lib.format.read_array_header_2_0(f)
+    return shape[0]
+
+
+def scan_feats_files(data_root):
+    """List ``*-feats.npy`` files in a directory.
+
+    Args:
+        data_root (str): Directory containing the features.
+
+    Returns:
+        list: Sorted list of paths.
+    """
+    return sorted(
+        entry.path
+        for entry in os.scandir(data_root)
+        if entry.name.endswith("-feats.npy") and not entry.name.startswith(".")
+    )
+
+
+def collect_lengths(data_root, files, num_workers=8):
+    """Collect the number of frames of features.
+
+    The number of frames are read from the .npy headers in parallel and cached
+    to ``lengths.npz`` in ``data_root``. The cache is re-used unless the list of
+    files changes or any of the files is modified after the cache is written.
+
+    Args:
+        data_root (str): Directory containing the features.
+        files (list): List of paths to the features in ``data_root``.
+        num_workers (int): Number of threads to read the headers.
+
+    Returns:
+        list: Number of frames of each file.
+    """
+    cache_path = join(data_root, "lengths.npz")
+    names = [basename(f) for f in files]
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        if exists(cache_path):
+            try:
+                cache_mtime = os.path.getmtime(cache_path)
+                with np.load(cache_path) as cache:
+                    cached_names = cache["names"].tolist()
+                    cached_lengths = cache["lengths"].tolist()
+            except Exception:
+                # NOTE: treat broken caches as a cache miss
+                cached_names = None
+            if cached_names == names and all(
+                mtime <= cache_mtime for mtime in executor.map(os.path.getmtime, files)
+            ):
+                return cached_lengths
+        lengths = list(executor.map(get_num_frames, files))
+
+    # NOTE: write to a temporary file and rename it so that other processes
+    # (e.g., DDP ranks) never read a partially written cache
+    tmp_path = None
+    try:
+        with tempfile.NamedTemporaryFile(
+            dir=data_root, prefix=".lengths-", suffix=".npz", delete=False
+        ) as f:
+            tmp_path = f.name
+            np.savez(
+                f,
+                names=np.array(names, dtype=str),
+                lengths=np.array(lengths, dtype=np.int64),
+            )
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        if tmp_path is not None and exists(tmp_path):
+            os.remove(tmp_path)
+
+    return lengths
 
 
 def get_filtered_files(
@@ -113,16 +302,17 @@ def get_filtered_files(
     filter_num_frames=6000,
     filter_min_num_frames=0,
 ):
-    files = sorted(glob(join(data_root, "*-feats.npy")))
+    files = scan_feats_files(data_root)
+    lengths = collect_lengths(data_root, files)
 
     if filter_long_segments:
-        valid_files = []
+        valid_files, valid_lengths = [], []
 
         num_filtered = 0
-        for path in files:
-            length = len(np.load(path))
+        for path, length in zip(files, lengths):
             if length < filter_num_frames and length > filter_min_num_frames:
                 valid_files.append(path)
+                valid_lengths.append(length)
             else:
                 if logger is not None:
                     logger.info(f"Filtered: {path} is too long or short: {length}")
@@ -132,7 +322,6 @@ def get_filtered_files(
 
         # Print stats of lengths
         if logger is not None:
-            lengths = [len(np.load(f)) for f in files]
             logger.debug(f"[before] Size of dataset: {len(files)}")
             logger.debug(f"[before] maximum length: {max(lengths)}")
             logger.debug(f"[before] minimum length: {min(lengths)}")
@@ -140,9 +329,8 @@ def get_filtered_files(
             logger.debug(f"[before] std length: {np.std(lengths)}")
             logger.debug(f"[before] median length: {np.median(lengths)}")
 
-        files = valid_files
+        files, lengths = valid_files, valid_lengths
 
-        lengths = [len(np.load(f)) for f in files]
         if logger is not None:
             logger.debug(f"[after] Size of dataset: {len(files)}")
             logger.debug(f"[after] maximum length: {max(lengths)}")
@@ -150,8 +338,6 @@ def get_filtered_files(
             logger.debug(f"[after] mean length: {np.mean(lengths)}")
             logger.debug(f"[after] std length: {np.std(lengths)}")
             logger.debug(f"[after] median length: {np.median(lengths)}")
-    else:
-        lengths = [len(np.load(f)) for f in files]
 
     return files, lengths
 
@@ -226,26 +412,321 @@ def batch_by_size(
     return batches
 
 
+def load_feats(path):
+    """Load features from a .npy file as float32.
+
+    The file is memory-mapped (copy-on-write) so that no heap allocation is made
+    on load and repeated reads are served from the OS page cache. A copy is made
+    only if the data is not stored as float32.
+
+    Args:
+        path (str): Path to the .npy file.
+
+    Returns:
+        np.ndarray: Features.
+    """
+    feats = np.load(path, mmap_mode="c")
+    if feats.dtype != np.float32:
+        feats = feats.astype(np.float32)
+    return feats
+
+
+class NpyFileSource(FileDataSource):
+    """File data source for features stored in ``*-feats.npy`` files
+
+    Args:
+        data_root (str): Directory containing the features.
+        logger (logging.Logger): Logger.
+    """
+
+    def __init__(self, data_root, logger=None):
+        self.data_root = data_root
+        self.logger = logger
+
+    def collect_files(self):
+        files = scan_feats_files(self.data_root)
+        if self.logger is not None:
+            self.logger.info(f"Found {len(files)} files in {self.data_root}")
+        return files
+
+    def collect_features(self, path):
+        return load_feats(path)
+
+
+def pack_npy_files(data_root, logger=None):
+    """Pack ``*-feats.npy`` files in a directory into a single archive
+
+    All the features are concatenated along the time axis and stored in
+    ``packed_archive.npy``. The file names, offsets and lengths of the features
+    are stored in ``packed_index.npz``. The archive can be read by
+    :class:`PackedNpyFileSource`.
+
+    .. note::
+
+        The archive is not updated automatically. Re-run this function if the
+        features are modified. Stale archives are ignored by
+        :class:`PackedNpyFileSource`.
+
+    Args:
+        data_root (str): Directory containing the features.
+        logger (logging.Logger): Logger.
+    """
+    files = scan_feats_files(data_root)
+    assert len(files) > 0, f"No features found in {data_root}"
+    lengths = np.array(collect_lengths(data_root, files), dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+    feat_dim = load_feats(files[0]).shape[-1]
+
+    packed_feats = np.lib.format.open_memmap(
+        join(data_root, "packed_archive.npy"),
+        mode="w+",
+        dtype=np.float32,
+        shape=(int(lengths.sum()), feat_dim),
+    )
+    for path, offset, length in zip(files, offsets, lengths):
+        packed_feats[offset : offset + length] = load_feats(path)
+    packed_feats.flush()
+    del packed_feats
+
+    np.savez(
+        join(data_root, "packed_index.npz"),
+        names=np.array([basename(f) for f in files]),
+        offsets=offsets,
+        lengths=lengths,
+    )
+    if logger is not None:
+        logger.info(f"Packed {len(files)} files in {data_root}")
+
+
+class PackedNpyFileSource(NpyFileSource):
+    """File data source for features packed by :func:`pack_npy_files`
+
+    Features are sliced from the memory-mapped archive, which avoids opening
+    a file per utterance. Falls back to loading individual ``*-feats.npy``
+    files if the archive does not exist or does not contain the features.
+    The archive is ignored if it is stale, i.e., any of the packed features is
+    modified after packing or has a different number of frames.
+
+    Args:
+        data_root (str): Directory containing the features.
+        logger (logging.Logger): Logger.
+    """
+
+    def __init__(self, data_root, logger=None):
+        super().__init__(data_root, logger)
+        index_path = join(data_root, "packed_index.npz")
+        if exists(index_path):
+            with np.load(index_path) as index:
+                self.index = {
+                    name: (offset, length)
+                    for name, offset, length in zip(
+                        index["names"], index["offsets"], index["lengths"]
+                    )
+                }
+            if self._is_stale(os.path.getmtime(index_path)):
+                if logger is not None:
+                    logger.warning(
+                        f"Packed features in {data_root} are outdated and ignored. "
+                        "Re-run pack_npy_files to use them."
+                    )
+                self.index = None
+            elif logger is not None:
+                logger.info(f"Use packed features in {data_root}")
+        else:
+            self.index = None
+        # NOTE: the archive is opened lazily in each process
+        self._packed_feats = None
+
+    def _is_stale(self, index_mtime):
+        # NOTE: use the same file list as get_filtered_files to re-use the cache
+        files = scan_feats_files(self.data_root)
+        for path, length in zip(files, collect_lengths(self.data_root, files)):
+            name = basename(path)
+            if name not in self.index:
+                continue
+            if self.index[name][1] != length or os.path.getmtime(path) > index_mtime:
+                return True
+        return False
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_packed_feats"] = None
+        return state
+
+    def collect_features(self, path):
+        name = basename(path)
+        if self.index is None or name not in self.index:
+            return load_feats(path)
+        if self._packed_feats is None:
+            self._packed_feats = np.load(
+                join(self.data_root, "packed_archive.npy"), mmap_mode="c"
+            )
+        offset, length = self.index[name]
+        return self._packed_feats[offset : offset + length]
+
+
+def _release_shared_memory(shm, owner_pid):
+    if os.getpid() == owner_pid:
+        shm.unlink()
+    try:
+        shm.close()
+    except BufferError:
+        # NOTE: views of the block are still alive. The memory is released
+        # once they are garbage-collected.
+        pass
+
+
+class SharedMemoryCache:
+    """In-memory cache of 2-D features backed by shared memory
+
+    All the features are loaded at construction time and stored in a single
+    contiguous shared memory block. DataLoader workers read the features from
+    the same block, so the cache is not duplicated for each worker.
+
+    Args:
+        keys (list): Keys (e.g., paths) of the features.
+        load_fn (callable): Function that loads the features for a key.
+        lengths (list): Number of frames of the features. If None, keys must be
+            paths to .npy files and the number of frames are read from the headers.
+    """
+
+    def __init__(self, keys, load_fn, lengths=None):
+        if lengths is None:
+            lengths = [get_num_frames(key) for key in keys]
+        self.lengths = np.array(lengths, dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(self.lengths)[:-1]]).astype(
+            np.int64
+        )
+        self.shape = (int(self.lengths.sum()), 1)
+
+        self._shm = None
+        for key, offset, length in zip(keys, self.offsets, self.lengths):
+            feats = load_fn(key)
+            if len(feats) != length:
+                raise ValueError(
+                    f"Number of frames of {key} is {len(feats)} but expected {length}"
+                )
+            # NOTE: the block is allocated once the feature dimension is known
+            if self._shm is None:
+                self.shape = (self.shape[0], feats.shape[-1])
+                self._allocate()
+            self._feats[offset : offset + length] = feats
+        if self._shm is None:
+            self._allocate()
+
+    def _allocate(self):
+        nbytes = self.shape[0] * self.shape[1] * np.dtype(np.float32).itemsize
+        # NOTE: writing beyond the capacity of /dev/shm causes SIGBUS,
+        # which cannot be handled. Check the capacity beforehand.
+        if os.path.isdir("/dev/shm") and shutil.disk_usage("/dev/shm").free < nbytes:
+            raise MemoryError(
+                f"Not enough shared memory to cache {nbytes} bytes of features"
+            )
+        self._shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        self._finalizer = weakref.finalize(
+            self, _release_shared_memory, self._shm, os.getpid()
+        )
+        self._feats = self._as_array()
+
+    def _as_array(self):
+        return np.ndarray(self.shape, dtype=np.float32, buffer=self._shm.buf)
+
+    def __getstate__(self):
+        # NOTE: only the name of the shared memory block is pickled
+        # so that spawned workers can attach to the same block
+        state = self.__dict__.copy()
+        state["_shm"] = self._shm.name
+        del state["_finalizer"], state["_feats"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # NOTE: the block is owned (and unlinked) by the parent process
+        self._shm = shared_memory.SharedMemory(name=state["_shm"])
+        self._finalizer = weakref.finalize(
+            self, _release_shared_memory, self._shm, None
+        )
+        self._feats = self._as_array()
+
+    def __getitem__(self, idx):
+        offset, length = self.offsets[idx], self.lengths[idx]
+        return self._feats[offset : offset + length]
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @property
+    def nbytes(self):
+        return self._feats.nbytes
+
+
 class Dataset(data_utils.Dataset):  # type: ignore
     """Dataset for numpy files
 
     Args:
         in_paths (list): List of paths to input files
         out_paths (list): List of paths to output files
+        lengths (list): List of the number of frames
+        shuffle (bool): Whether to shuffle the order of the mini-batches
+        allow_cache (bool): Whether to cache the features in memory. The cache is
+            shared among DataLoader workers if shared memory is available.
+        in_source (PackedNpyFileSource): Data source for input features.
+            If None, features are loaded from the individual files.
+        out_source (PackedNpyFileSource): Data source for output features.
+            If None, features are loaded from the individual files.
+        logger (logging.Logger): Logger.
     """
 
-    def __init__(self, in_paths, out_paths, lengths, shuffle=False, allow_cache=True):
+    def __init__(
+        self,
+        in_paths,
+        out_paths,
+        lengths,
+        shuffle=False,
+        allow_cache=True,
+        in_source=None,
+        out_source=None,
+        logger=None,
+    ):
         self.in_paths = in_paths
         self.out_paths = out_paths
+        self.in_source = in_source
+        self.out_source = out_source
         self.lengths = lengths
         self.sort_by_len = True
         self.shuffle = shuffle
         self.allow_cache = allow_cache
-        if allow_cache:
+        self.use_shared_memory = allow_cache and _shared_memory_available
+        if self.use_shared_memory:
+            try:
+                self.in_cache = SharedMemoryCache(
+                    in_paths, self._load_in_feats, lengths
+                )
+                self.out_cache = SharedMemoryCache(out_paths, self._load_out_feats)
+            except MemoryError as e:
+                # NOTE: e.g., /dev/shm of docker containers is 64MB by default
+                if logger is not None:
+                    logger.warning(
+                        f"{e}. Fall back to the cache without shared memory. "
+                        "Consider increasing the size of /dev/shm."
+                    )
+                self.in_cache, self.out_cache = None, None
+                self.use_shared_memory = False
+        if allow_cache and not self.use_shared_memory:
             self.manager = Manager()
             self.caches = self.manager.list()
             self.caches += [() for _ in range(len(in_paths))]
 
+    def _load_in_feats(self, path):
+        if self.in_source is not None:
+            return self.in_source.collect_features(path)
+        return load_feats(path)
+
+    def _load_out_feats(self, path):
+        if self.out_source is not None:
+            return self.out_source.collect_features(path)
+        return load_feats(path)
+
     def __getitem__(self, idx):
         """Get a pair of input and target
 
@@ -255,10 +736,14 @@ class Dataset(data_utils.Dataset):  # type: ignore
         Returns:
             tuple: input and target in numpy format
         """
+        if self.use_shared_memory:
+            return self.in_cache[idx], self.out_cache[idx]
         if self.allow_cache and len(self.caches[idx]) != 0:
             return self.caches[idx]
-        x, y = np.load(self.in_paths[idx]), np.load(self.out_paths[idx])
+        x = self._load_in_feats(self.in_paths[idx])
+        y = self._load_out_feats(self.out_paths[idx])
         if self.allow_cache:
+            # NOTE: memory-mapped arrays are materialized when sent to the cache
             self.caches[idx] = (x, y)
 
         return x, y
@@ -289,6 +774,36 @@ class Dataset(data_utils.Dataset):  # type: ignore
         return len(self.in_paths)
 
 
+class Batch:
+    """Mini-batch of input and output features
+
+    The batch can be unpacked like a tuple (i.e., ``x, y, lengths = batch``).
+    Custom memory pinning is implemented so that the tensors are always
+    page-locked if ``pin_memory=True`` is given to the DataLoader. Use
+    ``non_blocking=True`` when moving pinned tensors to GPUs.
+
+    Args:
+        x (torch.Tensor): Network inputs (B, max(T), D_in).
+        y (torch.Tensor): Network targets (B, max(T), D_out).
+        lengths (torch.LongTensor): Input lengths (B,).
+    """
+
+    __slots__ = ("x", "y", "lengths")
+
+    def __init__(self, x, y, lengths):
+        self.x = x
+        self.y = y
+        self.lengths = lengths
+
+    def pin_memory(self):
+        return Batch(
+            self.x.pin_memory(), self.y.pin_memory(), self.lengths.pin_memory()
+        )
+
+    def __iter__(self):
+        return iter((self.x, self.y, self.lengths))
+
+
 def ensure_divisible_by(feats, N):
     """Ensure that the number of frames is divisible by N.
 
@@ -310,6 +825,9 @@ def ensure_divisible_by(feats, N):
 def collate_fn_default(batch, reduction_factor=1, stream_sizes=None, streams=None):
     """Create batch
 
+    Samples are sorted by length in descending order so that the batch can be
+    directly fed to :func:`torch.nn.utils.rnn.pack_padded_sequence`.
+
     Args:
         batch(tuple): List of tuples
             - x[0] (ndarray,int) : list of (T, D_in)
@@ -317,49 +835,34 @@ def collate_fn_default(batch, reduction_factor=1, stream_sizes=None, streams=Non
         reduction_factor (int): Reduction factor.
 
     Returns:
-        tuple: Tuple of batch
+        Batch: Mini-batch that can be unpacked as follows:
             - x (FloatTensor) : Network inputs (B, max(T), D_in)
             - y (FloatTensor)  : Network targets (B, max(T), D_out)
-            - lengths (LongTensor): Input lengths
+            - lengths (LongTensor): Input lengths in descending order
     """
-    lengths = [len(ensure_divisible_by(x[0], reduction_factor)) for x in batch]
-    max_len = max(lengths)
-    x_batch = torch.stack(
-        [
-            torch.from_numpy(
-                pad_2d(ensure_divisible_by(x[0], reduction_factor), max_len)
+    # NOTE: This is needed for pytorch's PackedSequence
+    batch = sorted(batch, key=lambda x: len(x[0]), reverse=True)
+    xs = [ensure_divisible_by(x[0], reduction_factor) for x in batch]
+    if stream_sizes is not None:
+        assert streams is not None
+        ys = [
+            ensure_divisible_by(
+                select_streams(x[1], stream_sizes, streams), reduction_factor
             )
             for x in batch
         ]
-    )
-
-    if stream_sizes is not None:
-        assert streams is not None
-        y_batch = torch.stack(
-            [
-                torch.from_numpy(
-                    pad_2d(
-                        ensure_divisible_by(
-                            select_streams(x[1], stream_sizes, streams),
-                            reduction_factor,
-                        ),
-                        max_len,
-                    )
-                )
-                for x in batch
-            ]
-        )
     else:
-        y_batch = torch.stack(
-            [
-                torch.from_numpy(
-                    pad_2d(ensure_divisible_by(x[1], reduction_factor), max_len)
-                )
-                for x in batch
-            ]
-        )
+        ys = [ensure_divisible_by(x[1], reduction_factor) for x in batch]
+
+    # NOTE: pad all the samples in a single pass without intermediate padded arrays
+    xs = [torch.from_numpy(np.ascontiguousarray(x)).float() for x in xs]
+    ys = [torch.from_numpy(np.ascontiguousarray(y)).float() for y in ys]
+    x_batch = pad_sequence(xs, batch_first=True)
+    y_batch = pad_sequence(ys, batch_first=True)
+
+    lengths = [len(x) for x in xs]
     l_batch = torch.tensor(lengths, dtype=torch.long)
-    return x_batch, y_batch, l_batch
+    return Batch(x_batch, y_batch, l_batch)
 
 
 def collate_fn_random_segments(batch, max_time_frames=256):
@@ -378,7 +881,7 @@ def collate_fn_random_segments(batch, max_time_frames=256):
         max_time_frames (int, optional): Number of time frames. Defaults to 256.
 
     Returns:
-        tuple: Tuple of batch
+        Batch: Mini-batch that can be unpacked as follows:
             - x (FloatTensor) : Network inputs (B, max(T), D_in)
             - y (FloatTensor)  : Network targets (B, max(T), D_out)
             - lengths (LongTensor): Input lengths
@@ -400,7 +903,7 @@ def collate_fn_random_segments(batch, max_time_frames=256):
     # but just for consistency with collate_fn_default
     l_batch = torch.tensor([max_time_frames] * len(lengths), dtype=torch.long)
 
-    return x_batch, y_batch, l_batch
+    return Batch(x_batch, y_batch, l_batch)
 
 
 def get_data_loaders(data_config, collate_fn, logger):
@@ -433,6 +936,9 @@ def get_data_loaders(data_config, collate_fn, logger):
         filter_num_frames = data_config.filter_num_frames
         filter_min_num_frames = data_config.filter_min_num_frames
 
+    # Make mini-batches from utterances of similar lengths to reduce padding
+    group_by_length = data_config.get("group_by_length", False)
+
     data_loaders = {}
     samplers = {}
     for phase in ["train_no_dev", "dev"]:
@@ -455,6 +961,10 @@ def get_data_loaders(data_config, collate_fn, logger):
             filter_min_num_frames=filter_min_num_frames,
         )
 
+        # NOTE: features are read from packed archives if available
+        in_source = PackedNpyFileSource(in_dir, logger)
+        out_source = PackedNpyFileSource(out_dir, logger)
+
         # Dynamic batch size
         if data_config.batch_max_frames > 0:
             logger.debug(
@@ -466,6 +976,9 @@ def get_data_loaders(data_config, collate_fn, logger):
                 lengths,
                 shuffle=train,
                 allow_cache=data_config.get("allow_cache", False),
+                in_source=in_source,
+                out_source=out_source,
+                logger=logger,
             )
             if dist.is_initialized():
                 required_batch_size_multiple = dist.get_world_size()
@@ -498,9 +1011,44 @@ def get_data_loaders(data_config, collate_fn, logger):
                 "batch_sampler": ShuffleBatchSampler(batches) if train else batches,
             }
             sampler = None
+        elif group_by_length:
+            logger.debug(
+                f"Fixed batch size {data_config.batch_size} with grouping by length"
+            )
+            dataset = Dataset(
+                in_files,
+                out_files,
+                lengths,
+                allow_cache=data_config.get("allow_cache", False),
+                in_source=in_source,
+                out_source=out_source,
+                logger=logger,
+            )
+            if dist.is_initialized():
+                num_replicas, rank = dist.get_world_size(), dist.get_rank()
+            else:
+                num_replicas, rank = 1, 0
+            # NOTE: the sampler is returned so that set_epoch is called under DDP
+            sampler = LengthGroupedBatchSampler(
+                lengths,
+                data_config.batch_size,
+                shuffle=train,
+                num_replicas=num_replicas,
+                rank=rank,
+            )
+            logger.info(f"Num mini-batches: {len(sampler)}")
+            data_loader_extra_kwargs = {"batch_sampler": sampler}
         else:
             logger.debug(f"Fixed batch size: {data_config.batch_size}")
-            dataset = Dataset(in_files, out_files, lengths)
+            dataset = Dataset(
+                in_files,
+                out_files,
+                lengths,
+                allow_cache=data_config.get("allow_cache", False),
+                in_source=in_source,
+                out_source=out_source,
+                logger=logger,
+            )
             if dist.is_initialized():
                 sampler = torch.utils.data.distributed.DistributedSampler(
                     dataset, shuffle=train
@@ -515,6 +1063,15 @@ def get_data_loaders(data_config, collate_fn, logger):
                 "shuffle": shuffle,
             }
 
+        if data_config.num_workers > 0 and _dataloader_supports_persistent_workers:
+            # NOTE: keep workers alive across epochs to avoid re-spawning them
+            data_loader_extra_kwargs["persistent_workers"] = data_config.get(
+                "persistent_workers", True
+            )
+            data_loader_extra_kwargs["prefetch_factor"] = data_config.get(
+                "prefetch_factor", 2
+            )
+
         data_loaders[phase] = data_utils.DataLoader(
             dataset,
             collate_fn=collate_fn,
@@ -563,6 +1120,46 @@ def set_epochs_based_on_max_steps_(train_config, steps_per_epoch, logger):
     logger.info(f"Number of iterations: {train_config.max_train_steps}")
 
 
+# NOTE: a single worker keeps checkpoints written in the order they are saved
+_checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+_pending_checkpoints = []
+
+
+def _to_cpu(obj):
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    elif isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def _write_checkpoint(logger, checkpoint, path, latest_path=None):
+    torch.save(checkpoint, path)
+    logger.info(f"Saved checkpoint at {path}")
+
+    if latest_path is not None:
+        # NOTE: hard-link the latest checkpoint to avoid writing the same data twice
+        try:
+            latest_path.unlink()
+        except FileNotFoundError:
+            pass
+        try:
+            os.link(path, latest_path)
+        except OSError:
+            shutil.copyfile(path, latest_path)
+
+
+def wait_for_checkpoints():
+    """Wait until all checkpoints scheduled by :func:`save_checkpoint` are written.
+
+    Exceptions raised while writing checkpoints are re-raised here.
+    """
+    while len(_pending_checkpoints) > 0:
+        _pending_checkpoints.pop(0).result()
+
+
 def save_checkpoint(
     logger,
     out_dir,
@@ -575,6 +1172,9 @@ def save_checkpoint(
 ):
     """Save a checkpoint.
 
+    States are copied to CPU synchronously and written to disk on a background
+    thread. Call :func:`wait_for_checkpoints` to make sure the files exist.
+
     Args:
         logger (logging.Logger): Logger.
         out_dir (str): Output directory.
@@ -595,30 +1195,72 @@ def save_checkpoint(
     out_dir.mkdir(parents=True, exist_ok=True)
     if is_best:
         path = out_dir / f"best_loss{postfix}.pth"
+        latest_path = None
     else:
         path = out_dir / "epoch{:04d}{}.pth".format(epoch, postfix)
-    torch.save(
+        latest_path = out_dir / f"latest{postfix}.pth"
+    checkpoint = _to_cpu(
         {
             "state_dict": model.state_dict(),
             "optimizer_state": optimizer.state_dict(),
             "lr_scheduler_state": lr_scheduler.state_dict(),
-        },
-        path,
+        }
     )
 
-    logger.info(f"Saved checkpoint at {path}")
-    if not is_best:
-        shutil.copyfile(path, out_dir / f"latest{postfix}.pth")
+    # Re-raise errors of finished writes and keep the list short for long runs
+    for future in [f for f in _pending_checkpoints if f.done()]:
+        _pending_checkpoints.remove(future)
+        future.result()
+    _pending_checkpoints.append(
+        _checkpoint_executor.submit(
+            _write_checkpoint, logger, checkpoint, path, latest_path
+        )
+    )
 
 
-def get_stream_weight(stream_weights, stream_sizes):
+def get_stream_weight(stream_weights, stream_sizes, device=None):
+    """Get weights for stream-wise losses.
+
+    The returned tensor is cached per device and shared across calls. Do not
+    modify it in-place.
+
+    Args:
+        stream_weights (list): Stream weights. If None, weights are computed
+            based on the stream sizes.
+        stream_sizes (list): Stream sizes.
+        device (torch.device): Device of the returned tensor. Defaults to CPU.
+
+    Returns:
+        torch.Tensor: Stream weights.
+    """
+    if stream_weights is not None:
+        stream_weights = tuple(stream_weights)
+    device = torch.device("cpu") if device is None else torch.device(device)
+    return _get_stream_weight(stream_weights, tuple(stream_sizes), device)
+
+
+@lru_cache(maxsize=16)
+def _get_stream_weight(stream_weights, stream_sizes, device):
     if stream_weights is not None:
         assert len(stream_weights) == len(stream_sizes)
-        return torch.tensor(stream_weights)
+        return torch.tensor(stream_weights, device=device)
 
     S = sum(stream_sizes)
     w = torch.tensor(stream_sizes).float() / S
-    return w
+    return w.to(device)
+
+
+def get_local_rank():
+    """Get the local rank of the current process for distributed training
+
+    ``LOCAL_RANK`` set by ``torchrun`` is used if available.
+
+    Returns:
+        int: Local rank (i.e., index of the GPU to use on the node).
+    """
+    if "LOCAL_RANK" in os.environ:
+        return int(os.environ["LOCAL_RANK"])
+    return dist.get_rank() % torch.cuda.device_count()
 
 
 def _instantiate_optim(optim_config, model):
@@ -636,7 +1278,11 @@ def _instantiate_optim(optim_config, model):
 def _resume(logger, resume_config, model, optimizer, lr_scheduler):
     if resume_config.checkpoint is not None and len(resume_config.checkpoint) > 0:
         logger.info("Load weights from %s", resume_config.checkpoint)
-        checkpoint = torch.load(to_absolute_path(resume_config.checkpoint))
+        # NOTE: load tensors onto CPU to avoid allocating another copy of the
+        # parameters on GPU. They are copied to the model's device by load_state_dict.
+        checkpoint = torch.load(
+            to_absolute_path(resume_config.checkpoint), map_location="cpu"
+        )
         model.load_state_dict(checkpoint["state_dict"])
         if resume_config.load_optimizer:
             logger.info("Load optimizer state")
@@ -644,6 +1290,62 @@ def _resume(logger, resume_config, model, optimizer, lr_scheduler):
             lr_scheduler.load_state_dict(checkpoint["lr_scheduler_state"])
 
 
+def _load_scaler_npy(path):
+    # NOTE: check data_min/data_max first since they end with _min/_max
+    for key in ["data_min", "data_max", "mean", "var", "scale", "min"]:
+        if path.endswith(f"_{key}.npy"):
+            prefix = path[: -len(f"_{key}.npy")]
+            break
+    else:
+        raise ValueError(f"Unknown scaler statistics: {path}")
+
+    if exists(f"{prefix}_mean.npy"):
+        return StandardScaler(
+            np.load(f"{prefix}_mean.npy"),
+            np.load(f"{prefix}_var.npy"),
+            np.load(f"{prefix}_scale.npy"),
+        )
+    data_min, data_max = None, None
+    if exists(f"{prefix}_data_min.npy") and exists(f"{prefix}_data_max.npy"):
+        data_min = np.load(f"{prefix}_data_min.npy")
+        data_max = np.load(f"{prefix}_data_max.npy")
+    return MinMaxScaler(
+        np.load(f"{prefix}_min.npy"), np.load(f"{prefix}_scale.npy"), data_min, data_max
+    )
+
+
+def load_scaler(path, logger=None):
+    """Load a scaler
+
+    If ``path`` ends with ``.npy``, it must be one of the statistics files written
+    by ``recipes/_common/scaler_joblib2npy.py`` (e.g.,
+    ``in_acoustic_scaler_scale.npy``). The scaler is then built from the files
+    sharing the same prefix, which is much faster than unpickling the scaler with
+    joblib. Otherwise, the scaler is loaded by joblib.
+
+    Args:
+        path (str): Path to the scaler.
+        logger (logging.Logger): Logger.
+
+    Returns:
+        StandardScaler or MinMaxScaler: Scaler.
+    """
+    path = str(path)
+    if path.endswith(".npy"):
+        scaler = _load_scaler_npy(path)
+    else:
+        scaler = joblib.load(path)
+        if isinstance(scaler, SKStandardScaler):
+            scaler = StandardScaler(scaler.mean_, scaler.var_, scaler.scale_)
+        elif isinstance(scaler, SKMinMaxScaler):
+            scaler = MinMaxScaler(
+                scaler.min_, scaler.scale_, scaler.data_min_, scaler.data_max_
+            )
+    if logger is not None:
+        logger.info(f"Loaded {type(scaler).__name__} from {path}")
+    return scaler
+
+
 def setup(config, device, collate_fn=collate_fn_default):
     """Setup for training
 
@@ -675,6 +1377,17 @@ def setup(config, device, collate_fn=collate_fn_default):
         cudnn.deterministic = config.train.cudnn.deterministic
         logger.info(f"cudnn.deterministic: {cudnn.deterministic}")
         logger.info(f"cudnn.benchmark: {cudnn.benchmark}")
+
+        # Allow TF32 for float32 matmul/conv on Ampere or newer GPUs
+        matmul_precision = config.train.get("matmul_precision", "high")
+        # NOTE: TF32 flags are available in torch>=1.7
+        if hasattr(torch, "set_float32_matmul_precision"):
+            torch.set_float32_matmul_precision(matmul_precision)
+        if hasattr(torch.backends.cuda, "matmul"):
+            torch.backends.cuda.matmul.allow_tf32 = matmul_precision != "highest"
+        if hasattr(cudnn, "allow_tf32"):
+            cudnn.allow_tf32 = matmul_precision != "highest"
+        logger.info(f"float32 matmul precision: {matmul_precision}")
         if torch.backends.cudnn.version() is not None:
             logger.info(f"cuDNN version: {torch.backends.cudnn.version()}")
 
@@ -702,22 +1415,11 @@ def setup(config, device, collate_fn=collate_fn_default):
 
     # Distributed training
     if dist.is_initialized():
-        device_id = rank % torch.cuda.device_count()
+        device_id = get_local_rank()
         model = DDP(model, device_ids=[device_id])
 
-    # Optimizer
-    optimizer_class = getattr(optim, config.train.optim.optimizer.name)
-    optimizer = optimizer_class(
-        model.parameters(), **config.train.optim.optimizer.params
-    )
-
-    # Scheduler
-    lr_scheduler_class = getattr(
-        optim.lr_scheduler, config.train.optim.lr_scheduler.name
-    )
-    lr_scheduler = lr_scheduler_class(
-        optimizer, **config.train.optim.lr_scheduler.params
-    )
+    # Optimizer and LR scheduler
+    optimizer, lr_scheduler = _instantiate_optim(config.train.optim, model)
 
     # DataLoader
     data_loaders, samplers = get_data_loaders(config.data, collate_fn, logger)
@@ -727,23 +1429,17 @@ def setup(config, device, collate_fn=collate_fn_default):
     )
 
     # Resume
-    if (
-        config.train.resume.checkpoint is not None
-        and len(config.train.resume.checkpoint) > 0
-    ):
-        logger.info("Load weights from %s", config.train.resume.checkpoint)
-        checkpoint = torch.load(to_absolute_path(config.train.resume.checkpoint))
-        model.load_state_dict(checkpoint["state_dict"])
-        if config.train.resume.load_optimizer:
-            logger.info("Load optimizer state")
-            optimizer.load_state_dict(checkpoint["optimizer_state"])
-            lr_scheduler.load_state_dict(checkpoint["lr_scheduler_state"])
+    _resume(logger, config.train.resume, model, optimizer, lr_scheduler)
 
-    if config.data_parallel:
+    if config.data_parallel and dist.is_initialized():
+        logger.warning("data_parallel is ignored since distributed training is enabled")
+    elif config.data_parallel:
         model = nn.DataParallel(model)
 
     # Mlflow
     if config.mlflow.enabled:
+        import mlflow
+
         mlflow.set_tracking_uri("file://" + get_original_cwd() + "/mlruns")
         mlflow.set_experiment(config.mlflow.experiment)
         # NOTE: disable tensorboard if mlflow is enabled
@@ -751,6 +1447,8 @@ def setup(config, device, collate_fn=collate_fn_default):
         logger.info("Using mlflow instead of tensorboard")
     else:
         # Tensorboard
+        from torch.utils.tensorboard import SummaryWriter
+
         if rank == 0:
             writer = SummaryWriter(to_absolute_path(config.train.log_dir))
         else:
@@ -758,17 +1456,11 @@ def setup(config, device, collate_fn=collate_fn_default):
 
     # Scalers
     if "in_scaler_path" in config.data and config.data.in_scaler_path is not None:
-        in_scaler = joblib.load(to_absolute_path(config.data.in_scaler_path))
-        in_scaler = MinMaxScaler(
-            in_scaler.min_, in_scaler.scale_, in_scaler.data_min_, in_scaler.data_max_
-        )
+        in_scaler = load_scaler(to_absolute_path(config.data.in_scaler_path), logger)
     else:
         in_scaler = None
     if "out_scaler_path" in config.data and config.data.out_scaler_path is not None:
-        out_scaler = joblib.load(to_absolute_path(config.data.out_scaler_path))
-        out_scaler = StandardScaler(
-            out_scaler.mean_, out_scaler.var_, out_scaler.scale_
-        )
+        out_scaler = load_scaler(to_absolute_path(config.data.out_scaler_path), logger)
     else:
         out_scaler = None
 
@@ -817,6 +1509,17 @@ def setup_gan(config, device, collate_fn=collate_fn_default):
         cudnn.deterministic = config.train.cudnn.deterministic
         logger.info(f"cudnn.deterministic: {cudnn.deterministic}")
         logger.info(f"cudnn.benchmark: {cudnn.benchmark}")
+
+        # Allow TF32 for float32 matmul/conv on Ampere or newer GPUs
+        matmul_precision = config.train.get("matmul_precision", "high")
+        # NOTE: TF32 flags are available in torch>=1.7
+        if hasattr(torch, "set_float32_matmul_precision"):
+            torch.set_float32_matmul_precision(matmul_precision)
+        if hasattr(torch.backends.cuda, "matmul"):
+            torch.backends.cuda.matmul.allow_tf32 = matmul_precision != "highest"
+        if hasattr(cudnn, "allow_tf32"):
+            cudnn.allow_tf32 = matmul_precision != "highest"
+        logger.info(f"float32 matmul precision: {matmul_precision}")
         if torch.backends.cudnn.version() is not None:
             logger.info(f"cuDNN version: {torch.backends.cudnn.version()}")
 
@@ -833,8 +1536,17 @@ def setup_gan(config, device, collate_fn=collate_fn_default):
     else:
         grad_scaler = None
 
+    # NOTE: channels-last memory format may speed up 2D convolutions on GPUs
+    memory_format = (
+        torch.channels_last
+        if config.train.get("channels_last", False)
+        else torch.preserve_format
+    )
+
     # Model G
-    netG = hydra.utils.instantiate(config.model.netG).to(device)
+    netG = hydra.utils.instantiate(config.model.netG).to(
+        device, memory_format=memory_format
+    )
     logger.info(netG)
     logger.info(
         "[Generator] Number of trainable params: {:.3f} million".format(
@@ -843,14 +1555,16 @@ def setup_gan(config, device, collate_fn=collate_fn_default):
     )
 
     if dist.is_initialized():
-        device_id = rank % torch.cuda.device_count()
+        device_id = get_local_rank()
         netG = DDP(netG, device_ids=[device_id])
 
     # Optimizer and LR scheduler for G
     optG, schedulerG = _instantiate_optim(config.train.optim.netG, netG)
 
     # Model D
-    netD = hydra.utils.instantiate(config.model.netD).to(device)
+    netD = hydra.utils.instantiate(config.model.netD).to(
+        device, memory_format=memory_format
+    )
     logger.info(netD)
     logger.info(
         "[Discriminator] Number of trainable params: {:.3f} million".format(
@@ -859,7 +1573,7 @@ def setup_gan(config, device, collate_fn=collate_fn_default):
     )
 
     if dist.is_initialized():
-        device_id = rank % torch.cuda.device_count()
+        device_id = get_local_rank()
         netD = DDP(netD, device_ids=[device_id])
 
     # Optimizer and LR scheduler for D
@@ -876,12 +1590,16 @@ def setup_gan(config, device, collate_fn=collate_fn_default):
     _resume(logger, config.train.resume.netG, netG, optG, schedulerG)
     _resume(logger, config.train.resume.netD, netD, optD, schedulerD)
 
-    if config.data_parallel:
+    if config.data_parallel and dist.is_initialized():
+        logger.warning("data_parallel is ignored since distributed training is enabled")
+    elif config.data_parallel:
         netG = nn.DataParallel(netG)
         netD = nn.DataParallel(netD)
 
     # Mlflow
     if config.mlflow.enabled:
+        import mlflow
+
         mlflow.set_tracking_uri("file://" + get_original_cwd() + "/mlruns")
         mlflow.set_experiment(config.mlflow.experiment)
         # NOTE: disable tensorboard if mlflow is enabled
@@ -889,25 +1607,17 @@ def setup_gan(config, device, collate_fn=collate_fn_default):
         logger.info("Using mlflow instead of tensorboard")
     else:
         # Tensorboard
+        from torch.utils.tensorboard import SummaryWriter
+
         writer = SummaryWriter(to_absolute_path(config.train.log_dir))
 
     # Scalers
     if "in_scaler_path" in config.data and config.data.in_scaler_path is not None:
-        in_scaler = joblib.load(to_absolute_path(config.data.in_scaler_path))
-        if isinstance(in_scaler, SKMinMaxScaler):
-            in_scaler = MinMaxScaler(
-                in_scaler.min_,
-                in_scaler.scale_,
-                in_scaler.data_min_,
-                in_scaler.data_max_,
-            )
+        in_scaler = load_scaler(to_absolute_path(config.data.in_scaler_path), logger)
     else:
         in_scaler = None
     if "out_scaler_path" in config.data and config.data.out_scaler_path is not None:
-        out_scaler = joblib.load(to_absolute_path(config.data.out_scaler_path))
-        out_scaler = StandardScaler(
-            out_scaler.mean_, out_scaler.var_, out_scaler.scale_
-        )
+        out_scaler = load_scaler(to_absolute_path(config.data.out_scaler_path), logger)
     else:
         out_scaler = None
 
@@ -39,7 +39,12 @@ if __name__ == "__main__":
         min_path = out_dir / (input_file.stem + "_min.npy")
         scale_path = out_dir / (input_file.stem + "_scale.npy")
 
+        data_min_path = out_dir / (input_file.stem + "_data_min.npy")
+        data_max_path = out_dir / (input_file.stem + "_data_max.npy")
+
         np.save(min_path, scaler.min_, allow_pickle=False)
         np.save(scale_path, scaler.scale_, allow_pickle=False)
+        np.save(data_min_path, scaler.data_min_, allow_pickle=False)
+        np.save(data_max_path, scaler.data_max_, allow_pickle=False)
     else:
         raise ValueError(f"Unknown scaler type: {type(scaler)}")
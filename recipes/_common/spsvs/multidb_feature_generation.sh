@@ -44,6 +44,8 @@ for inout in "in" "out"; do
             out_path=$scaler_path ${ext}
         rm -f train_list.txt
         cp -v $scaler_path $dump_norm_dir/${inout}_${typ}_scaler.joblib
+        # NOTE: statistics in .npy files are much faster to load than joblib files
+        python $NNSVS_COMMON_ROOT/scaler_joblib2npy.py $scaler_path $dump_norm_dir
     done
 done
 
@@ -23,14 +23,21 @@ else
     post_args=""
 fi
 
+# Use the statistics in .npy files if available since they are faster to load
+if [ -e $dump_norm_dir/in_acoustic_scaler_scale.npy ] && [ -e $dump_norm_dir/out_acoustic_scaler_scale.npy ]; then
+    scaler_suffix="_scale.npy"
+else
+    scaler_suffix=".joblib"
+fi
+
 xrun python $NNSVS_ROOT/nnsvs/bin/train_acoustic.py $ext $hydra_opt \
     model=$acoustic_model train=$acoustic_train data=$acoustic_data \
     data.train_no_dev.in_dir=$dump_norm_dir/$train_set/in_acoustic/ \
     data.train_no_dev.out_dir=$dump_norm_dir/$train_set/out_acoustic/ \
     data.dev.in_dir=$dump_norm_dir/$dev_set/in_acoustic/ \
     data.dev.out_dir=$dump_norm_dir/$dev_set/out_acoustic/ \
-    data.in_scaler_path=$dump_norm_dir/in_acoustic_scaler.joblib \
-    data.out_scaler_path=$dump_norm_dir/out_acoustic_scaler.joblib \
+    data.in_scaler_path=$dump_norm_dir/in_acoustic_scaler${scaler_suffix} \
+    data.out_scaler_path=$dump_norm_dir/out_acoustic_scaler${scaler_suffix} \
     ++data.sample_rate=$sample_rate \
     train.out_dir=$expdir/${acoustic_model} \
     train.log_dir=tensorboard/${expname}_${acoustic_model} \
@@ -23,14 +23,21 @@ else
     post_args=""
 fi
 
+# Use the statistics in .npy files if available since they are faster to load
+if [ -e $dump_norm_dir/in_duration_scaler_scale.npy ] && [ -e $dump_norm_dir/out_duration_scaler_scale.npy ]; then
+    scaler_suffix="_scale.npy"
+else
+    scaler_suffix=".joblib"
+fi
+
 xrun python $NNSVS_ROOT/nnsvs/bin/train.py $ext $hydra_opt \
     model=$duration_model train=$duration_train data=$duration_data \
     data.train_no_dev.in_dir=$dump_norm_dir/$train_set/in_duration/ \
     data.train_no_dev.out_dir=$dump_norm_dir/$train_set/out_duration/ \
     data.dev.in_dir=$dump_norm_dir/$dev_set/in_duration/ \
     data.dev.out_dir=$dump_norm_dir/$dev_set/out_duration/ \
-    data.in_scaler_path=$dump_norm_dir/in_duration_scaler.joblib \
-    data.out_scaler_path=$dump_norm_dir/out_duration_scaler.joblib \
+    data.in_scaler_path=$dump_norm_dir/in_duration_scaler${scaler_suffix} \
+    data.out_scaler_path=$dump_norm_dir/out_duration_scaler${scaler_suffix} \
     train.out_dir=$expdir/${duration_model} \
     train.log_dir=tensorboard/${expname}_${duration_model} \
     train.resume.checkpoint=$resume_checkpoint $post_args
@@ -23,14 +23,21 @@ else
     post_args=""
 fi
 
+# Use the statistics in .npy files if available since they are faster to load
+if [ -e $dump_norm_dir/in_timelag_scaler_scale.npy ] && [ -e $dump_norm_dir/out_timelag_scaler_scale.npy ]; then
+    scaler_suffix="_scale.npy"
+else
+    scaler_suffix=".joblib"
+fi
+
 xrun python $NNSVS_ROOT/nnsvs/bin/train.py $ext $hydra_opt \
     model=$timelag_model train=$timelag_train data=$timelag_data \
     data.train_no_dev.in_dir=$dump_norm_dir/$train_set/in_timelag/ \
     data.train_no_dev.out_dir=$dump_norm_dir/$train_set/out_timelag/ \
     data.dev.in_dir=$dump_norm_dir/$dev_set/in_timelag/ \
     data.dev.out_dir=$dump_norm_dir/$dev_set/out_timelag/ \
-    data.in_scaler_path=$dump_norm_dir/in_timelag_scaler.joblib \
-    data.out_scaler_path=$dump_norm_dir/out_timelag_scaler.joblib \
+    data.in_scaler_path=$dump_norm_dir/in_timelag_scaler${scaler_suffix} \
+    data.out_scaler_path=$dump_norm_dir/out_timelag_scaler${scaler_suffix} \
     train.out_dir=$expdir/${timelag_model} \
     train.log_dir=tensorboard/${expname}_${timelag_model} \
     train.resume.checkpoint=$resume_checkpoint $post_args
@@ -0,0 +1,480 @@
+import os
+import pickle
+import shutil
+import sys
+
+import joblib
+import numpy as np
+import pytest
+import torch
+import torch.distributed as dist
+from nnmnkwii.datasets import FileSourceDataset
+from nnsvs.logger import getLogger
+from nnsvs.train_util import (
+    Batch,
+    Dataset,
+    LengthGroupedBatchSampler,
+    NpyFileSource,
+    PackedNpyFileSource,
+    SharedMemoryCache,
+    batch_by_size,
+    collate_fn_default,
+    collect_lengths,
+    get_data_loaders,
+    get_filtered_files,
+    get_num_frames,
+    get_stream_weight,
+    load_feats,
+    load_scaler,
+    num_trainable_params,
+    pack_npy_files,
+    save_checkpoint,
+    scan_feats_files,
+    wait_for_checkpoints,
+)
+from nnsvs.util import MinMaxScaler, StandardScaler, pad_2d
+from omegaconf import ListConfig, OmegaConf
+from sklearn.preprocessing import MinMaxScaler as SKMinMaxScaler
+from sklearn.preprocessing import StandardScaler as SKStandardScaler
+
+
+def _make_batch(lengths, in_dim=4, out_dim=3):
+    return [
+        (
+            np.random.rand(T, in_dim).astype(np.float32),
+            np.random.rand(T, out_dim).astype(np.float32),
+        )
+        for T in lengths
+    ]
+
+
+def test_collate_fn_default():
+    batch = _make_batch([10, 7, 12])
+    x, y, lengths = collate_fn_default(batch)
+
+    assert x.shape == (3, 12, 4)
+    assert y.shape == (3, 12, 3)
+    assert x.dtype == torch.float32
+    # Sorted by length in descending order
+    assert lengths.tolist() == [12, 10, 7]
+    for idx, (x_, y_) in enumerate(
+        sorted(batch, key=lambda b: len(b[0]), reverse=True)
+    ):
+        assert np.allclose(x[idx].numpy(), pad_2d(x_, 12))
+        assert np.allclose(y[idx].numpy(), pad_2d(y_, 12))
+
+
+def test_collate_fn_default_reduction_factor():
+    batch = _make_batch([10, 7, 12])
+    x, y, lengths = collate_fn_default(batch, reduction_factor=4)
+
+    assert x.shape == (3, 12, 4)
+    assert lengths.tolist() == [12, 8, 4]
+    assert (x[2, 4:] == 0).all()
+
+
+def test_get_num_frames(tmp_path):
+    for T in [1, 10, 123]:
+        path = tmp_path / f"{T}-feats.npy"
+        np.save(path, np.zeros((T, 5), dtype=np.float32))
+        assert get_num_frames(path) == T
+
+
+def test_get_filtered_files(tmp_path):
+    for idx, T in enumerate([10, 300, 50]):
+        np.save(tmp_path / f"{idx}-feats.npy", np.zeros((T, 2), dtype=np.float32))
+
+    files, lengths = get_filtered_files(str(tmp_path), None)
+    assert len(files) == 3
+    assert lengths == [10, 300, 50]
+
+    files, lengths = get_filtered_files(
+        str(tmp_path), None, filter_long_segments=True, filter_num_frames=100
+    )
+    assert len(files) == 2
+    assert lengths == [10, 50]
+
+
+def test_batch_by_size_max_sentences():
+    lengths = [5, 1, 4, 2, 3, 6, 7]
+    indices = np.argsort(lengths, kind="mergesort")
+    batches = batch_by_size(indices, lambda idx: lengths[idx], max_sentences=3)
+    assert [len(b) for b in batches] == [3, 3, 1]
+    assert [sorted(lengths[idx] for idx in b) for b in batches] == [
+        [1, 2, 3],
+        [4, 5, 6],
+        [7],
+    ]
+
+
+def test_length_grouped_batch_sampler():
+    lengths = np.random.RandomState(0).randint(10, 1000, size=101)
+    sampler = LengthGroupedBatchSampler(lengths, 8)
+    assert len(sampler) == 13
+
+    epochs = [list(sampler) for _ in range(2)]
+    for batches in epochs:
+        assert len(batches) == len(sampler)
+        assert sorted(sum(batches, [])) == list(range(len(lengths)))
+        # Utterances of similar lengths are grouped together
+        padded = sum(len(b) * lengths[b].max() for b in batches)
+        assert padded < 1.25 * lengths.sum()
+    # Mini-batches are re-built at every epoch
+    assert sorted(map(sorted, epochs[0])) != sorted(map(sorted, epochs[1]))
+
+    # No randomness for evaluation
+    sampler = LengthGroupedBatchSampler(lengths, 8, shuffle=False)
+    assert list(sampler) == list(sampler)
+
+
+def _make_data_config(root, lengths, **kwargs):
+    for phase in ["train_no_dev", "dev"]:
+        for typ, dim in [("in", 4), ("out", 3)]:
+            (root / phase / typ).mkdir(parents=True)
+            for idx, T in enumerate(lengths):
+                np.save(
+                    root / phase / typ / f"{idx:03d}-feats.npy",
+                    np.full((T, dim), idx, dtype=np.float32),
+                )
+    config = {
+        phase: {
+            "in_dir": str(root / phase / "in"),
+            "out_dir": str(root / phase / "out"),
+        }
+        for phase in ["train_no_dev", "dev"]
+    }
+    config.update(
+        {
+            "num_workers": 0,
+            "batch_size": 4,
+            "batch_max_frames": -1,
+            "pin_memory": False,
+            "allow_cache": False,
+            "filter_long_segments": False,
+            "filter_num_frames": 6000,
+            "filter_min_num_frames": 0,
+        }
+    )
+    config.update(kwargs)
+    return OmegaConf.create(config)
+
+
+def test_get_data_loaders_group_by_length_ddp(tmp_path, monkeypatch):
+    lengths = [10 + (idx * 7) % 40 for idx in range(23)]
+    data_config = _make_data_config(tmp_path, lengths, group_by_length=True)
+    num_replicas = 2
+    monkeypatch.setattr(dist, "is_initialized", lambda: True)
+    monkeypatch.setattr(dist, "get_world_size", lambda: num_replicas)
+
+    seen = set()
+    for rank in range(num_replicas):
+        monkeypatch.setattr(dist, "get_rank", lambda: rank)
+        data_loaders, _ = get_data_loaders(
+            data_config, collate_fn_default, getLogger(0)
+        )
+        batch_sizes = []
+        for x, _, _ in data_loaders["train_no_dev"]:
+            batch_sizes.append(len(x))
+            seen |= set(x[:, 0, 0].long().tolist())
+        # Same batch size per rank as DistributedSampler
+        num_batches = int(np.ceil(len(lengths) / (4 * num_replicas)))
+        assert batch_sizes == [data_config.batch_size] * num_batches
+    assert seen == set(range(len(lengths)))
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_load_feats(tmp_path, dtype):
+    x = np.random.rand(10, 3).astype(dtype)
+    np.save(tmp_path / "utt-feats.npy", x)
+    feats = load_feats(tmp_path / "utt-feats.npy")
+    assert feats.dtype == np.float32
+    assert np.allclose(feats, x)
+    # Modifications must not be written back to the file
+    feats[:] = 0
+    assert np.allclose(np.load(tmp_path / "utt-feats.npy"), x)
+
+
+def test_npy_file_source(tmp_path):
+    for idx, T in enumerate([10, 20]):
+        np.save(tmp_path / f"{idx}-feats.npy", np.zeros((T, 2), dtype=np.float32))
+    np.save(tmp_path / "0-wave.npy", np.zeros(100, dtype=np.float32))
+    dataset = FileSourceDataset(NpyFileSource(str(tmp_path)))
+    assert len(dataset) == 2
+    assert dataset[1].shape == (20, 2)
+
+
+def test_packed_npy_file_source(tmp_path):
+    feats = [np.random.rand(T, 3).astype(np.float32) for T in [10, 5, 20]]
+    for idx, x in enumerate(feats):
+        np.save(tmp_path / f"{idx}-feats.npy", x)
+
+    # Fallback to the individual files
+    dataset = FileSourceDataset(PackedNpyFileSource(str(tmp_path)))
+    assert dataset.file_data_source.index is None
+    for idx, x in enumerate(feats):
+        assert np.allclose(dataset[idx], x)
+
+    pack_npy_files(str(tmp_path))
+    dataset = FileSourceDataset(PackedNpyFileSource(str(tmp_path)))
+    assert len(dataset) == 3
+    assert dataset.file_data_source.index is not None
+    for idx, x in enumerate(feats):
+        assert dataset[idx].dtype == np.float32
+        assert np.allclose(dataset[idx], x)
+    # The archive must not be listed as an utterance by the recipes
+    assert sorted(p.name for p in tmp_path.glob("*feats.npy")) == [
+        f"{idx}-feats.npy" for idx in range(3)
+    ]
+
+    # Stale archives are ignored: modified after packing or different lengths
+    index_mtime = os.path.getmtime(tmp_path / "packed_index.npz")
+    for new_feats, mtime in [
+        (feats[1] + 1.0, index_mtime + 10),
+        (np.random.rand(7, 3).astype(np.float32), index_mtime - 10),
+    ]:
+        np.save(tmp_path / "1-feats.npy", new_feats)
+        os.utime(tmp_path / "1-feats.npy", (mtime, mtime))
+        (tmp_path / "lengths.npz").unlink()
+        source = PackedNpyFileSource(str(tmp_path))
+        assert source.index is None
+        x = source.collect_features(str(tmp_path / "1-feats.npy"))
+        assert np.allclose(x, new_feats)
+
+
+@pytest.mark.skipif(
+    sys.version_info < (3, 8), reason="shared_memory requires python 3.8+"
+)
+def test_shared_memory_cache(tmp_path):
+    feats = [np.random.rand(T, 3).astype(np.float32) for T in [10, 5, 20]]
+    num_loads = [0] * len(feats)
+
+    def load_fn(idx):
+        num_loads[idx] += 1
+        return feats[idx]
+
+    cache = SharedMemoryCache(list(range(3)), load_fn, [len(x) for x in feats])
+    assert len(cache) == 3
+    assert cache.nbytes == 35 * 3 * 4
+    assert num_loads == [1, 1, 1]
+    for idx, x in enumerate(feats):
+        assert np.allclose(cache[idx], x)
+
+    # Number of frames are read from the .npy headers if not given
+    paths = []
+    for idx, x in enumerate(feats):
+        paths.append(tmp_path / f"{idx}-feats.npy")
+        np.save(paths[-1], x)
+    cache = SharedMemoryCache(paths, load_feats)
+    for idx, x in enumerate(feats):
+        assert np.allclose(cache[idx], x)
+
+    with pytest.raises(ValueError):
+        SharedMemoryCache(list(range(3)), load_fn, [10, 5, 10])
+
+
+@pytest.mark.skipif(
+    sys.version_info < (3, 8), reason="shared_memory requires python 3.8+"
+)
+def test_shared_memory_cache_pickle():
+    feats = [np.random.rand(T, 3).astype(np.float32) for T in [10, 5, 20]]
+    cache = SharedMemoryCache(list(range(3)), feats.__getitem__, [10, 5, 20])
+
+    # Attach to the same shared memory block
+    cache2 = pickle.loads(pickle.dumps(cache))
+    for idx, x in enumerate(feats):
+        assert np.allclose(cache2[idx], x)
+    cache._feats[:] = 0
+    assert (cache2[0] == 0).all()
+    del cache2
+    # The block is still alive for the owner
+    assert (cache[0] == 0).all()
+
+
+def test_shared_memory_cache_dataloader(tmp_path):
+    in_paths, out_paths, lengths = [], [], []
+    for idx, T in enumerate([10, 5, 20, 7]):
+        in_paths.append(tmp_path / f"{idx}-in.npy")
+        out_paths.append(tmp_path / f"{idx}-out.npy")
+        np.save(in_paths[-1], np.full((T, 4), idx, dtype=np.float32))
+        np.save(out_paths[-1], np.full((T, 2), -idx, dtype=np.float32))
+        lengths.append(T)
+    dataset = Dataset(in_paths, out_paths, lengths, allow_cache=True)
+
+    data_loader = torch.utils.data.DataLoader(
+        dataset, batch_size=2, num_workers=1, collate_fn=collate_fn_default
+    )
+    for _ in range(2):
+        seen = []
+        for x, y, batch_lengths in data_loader:
+            for x_, y_, T in zip(x, y, batch_lengths):
+                idx = int(x_[0, 0])
+                assert T == lengths[idx]
+                assert (x_[:T] == idx).all() and (y_[:T] == -idx).all()
+                seen.append(idx)
+        assert sorted(seen) == list(range(4))
+
+
+@pytest.mark.parametrize("allow_cache", [False, True])
+def test_dataset(tmp_path, allow_cache):
+    in_paths, out_paths, lengths = [], [], []
+    for idx, T in enumerate([10, 5, 20]):
+        in_paths.append(tmp_path / f"{idx}-in.npy")
+        out_paths.append(tmp_path / f"{idx}-out.npy")
+        np.save(in_paths[-1], np.full((T, 4), idx, dtype=np.float32))
+        np.save(out_paths[-1], np.full((T, 2), -idx, dtype=np.float64))
+        lengths.append(T)
+
+    dataset = Dataset(in_paths, out_paths, lengths, allow_cache=allow_cache)
+    assert len(dataset) == 3
+    for _ in range(2):
+        for idx, T in enumerate(lengths):
+            x, y = dataset[idx]
+            assert x.shape == (T, 4) and y.shape == (T, 2)
+            assert y.dtype == np.float32
+            assert (x == idx).all() and (y == -idx).all()
+
+
+@pytest.mark.skipif(
+    sys.version_info < (3, 8) or not os.path.isdir("/dev/shm"),
+    reason="shared_memory requires python 3.8+ and /dev/shm",
+)
+def test_dataset_shared_memory_fallback(tmp_path, monkeypatch):
+    in_paths, out_paths, lengths = [], [], []
+    for idx, T in enumerate([10, 5, 20]):
+        in_paths.append(tmp_path / f"{idx}-in.npy")
+        out_paths.append(tmp_path / f"{idx}-out.npy")
+        np.save(in_paths[-1], np.full((T, 4), idx, dtype=np.float32))
+        np.save(out_paths[-1], np.full((T, 2), -idx, dtype=np.float32))
+        lengths.append(T)
+
+    # Pretend that /dev/shm is full
+    usage = shutil.disk_usage(tmp_path)
+    monkeypatch.setattr(shutil, "disk_usage", lambda _: usage._replace(free=0))
+    dataset = Dataset(
+        in_paths, out_paths, lengths, allow_cache=True, logger=getLogger(0)
+    )
+    assert not dataset.use_shared_memory
+    for _ in range(2):
+        for idx, T in enumerate(lengths):
+            x, y = dataset[idx]
+            assert x.shape == (T, 4) and (x == idx).all() and (y == -idx).all()
+
+
+def test_batch():
+    batch = collate_fn_default(_make_batch([10, 7]))
+    assert isinstance(batch, Batch)
+    x, y, lengths = batch
+    assert x is batch.x and y is batch.y and lengths is batch.lengths
+
+    batch = pickle.loads(pickle.dumps(batch))
+    assert torch.equal(batch.x, x)
+    assert torch.equal(batch.lengths, lengths)
+
+
+def test_num_trainable_params():
+    model = torch.nn.Sequential(torch.nn.Linear(3, 4), torch.nn.Linear(4, 2))
+    assert num_trainable_params(model) == (3 * 4 + 4) + (4 * 2 + 2)
+    model[0].weight.requires_grad = False
+    assert num_trainable_params(model) == 4 + (4 * 2 + 2)
+
+
+def test_collect_lengths(tmp_path):
+    for idx, T in enumerate([10, 5, 20]):
+        np.save(tmp_path / f"{idx}-feats.npy", np.zeros((T, 2), dtype=np.float32))
+    np.save(tmp_path / "0-wave.npy", np.zeros(100, dtype=np.float32))
+
+    files = scan_feats_files(str(tmp_path))
+    assert [os.path.basename(f) for f in files] == [f"{i}-feats.npy" for i in range(3)]
+    assert collect_lengths(str(tmp_path), files) == [10, 5, 20]
+    assert (tmp_path / "lengths.npz").exists()
+    # Use cache
+    assert collect_lengths(str(tmp_path), files) == [10, 5, 20]
+
+    # Cache must be invalidated if features are modified
+    np.save(files[1], np.zeros((7, 2), dtype=np.float32))
+    mtime = os.path.getmtime(tmp_path / "lengths.npz")
+    os.utime(files[1], (mtime + 1, mtime + 1))
+    assert collect_lengths(str(tmp_path), files) == [10, 7, 20]
+    assert collect_lengths(str(tmp_path), files[:2]) == [10, 7]
+
+    # Broken (e.g., partially written) caches must be ignored and overwritten
+    (tmp_path / "lengths.npz").write_bytes(b"PK\x03\x04")
+    assert collect_lengths(str(tmp_path), files) == [10, 7, 20]
+    assert collect_lengths(str(tmp_path), files) == [10, 7, 20]
+    assert sorted(p.name for p in tmp_path.glob("*.npz")) == ["lengths.npz"]
+    assert not any(p.name.startswith(".") for p in tmp_path.iterdir())
+
+
+@pytest.mark.parametrize(
+    "scaler_class,nnsvs_scaler_class",
+    [(SKStandardScaler, StandardScaler), (SKMinMaxScaler, MinMaxScaler)],
+)
+def test_load_scaler(tmp_path, scaler_class, nnsvs_scaler_class):
+    x = np.random.rand(100, 4)
+    scaler = scaler_class().fit(x)
+    scaler_path = tmp_path / "scaler.joblib"
+    joblib.dump(scaler, scaler_path)
+
+    def _check(loaded):
+        assert isinstance(loaded, nnsvs_scaler_class)
+        assert np.allclose(loaded.transform(x), scaler.transform(x))
+        assert np.allclose(loaded.inverse_transform(x), scaler.inverse_transform(x))
+
+    _check(load_scaler(scaler_path))
+
+    # Same layout as recipes/_common/scaler_joblib2npy.py
+    if scaler_class == SKStandardScaler:
+        keys = ["mean", "scale", "var"]
+    else:
+        keys = ["min", "scale", "data_min", "data_max"]
+    for key in keys:
+        np.save(tmp_path / f"scaler_{key}.npy", getattr(scaler, f"{key}_"))
+    for key in keys:
+        loaded = load_scaler(tmp_path / f"scaler_{key}.npy")
+        _check(loaded)
+        if scaler_class == SKMinMaxScaler:
+            assert np.allclose(loaded.data_min_, scaler.data_min_)
+            assert np.allclose(loaded.data_max_, scaler.data_max_)
+
+    with pytest.raises(ValueError):
+        load_scaler(tmp_path / "scaler.npy")
+
+
+def test_save_checkpoint(tmp_path):
+    logger = getLogger(0)
+    model = torch.nn.Linear(3, 2)
+    optimizer = torch.optim.Adam(model.parameters())
+    lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=1)
+    for epoch in [1, 2]:
+        save_checkpoint(logger, tmp_path, model, optimizer, lr_scheduler, epoch)
+    save_checkpoint(logger, tmp_path, model, optimizer, lr_scheduler, 2, is_best=True)
+    expected = {k: v.clone() for k, v in model.state_dict().items()}
+    # Checkpoints must not be affected by updates after save_checkpoint returns
+    with torch.no_grad():
+        model.weight.add_(1.0)
+    wait_for_checkpoints()
+
+    for name in ["epoch0001.pth", "epoch0002.pth", "latest.pth", "best_loss.pth"]:
+        assert (tmp_path / name).exists()
+    assert (tmp_path / "latest.pth").read_bytes() == (
+        tmp_path / "epoch0002.pth"
+    ).read_bytes()
+    checkpoint = torch.load(tmp_path / "latest.pth")
+    for k, v in expected.items():
+        assert torch.equal(checkpoint["state_dict"][k], v)
+
+
+def test_get_stream_weight():
+    w = get_stream_weight(None, [3, 1])
+    assert torch.allclose(w, torch.tensor([0.75, 0.25]))
+    assert get_stream_weight(None, [3, 1]) is w
+    assert get_stream_weight(None, [3, 1], "cpu") is w
+
+    # Cached per device
+    device = torch.device("meta")
+    w = get_stream_weight(None, [3, 1], device)
+    assert w.device == device
+    assert get_stream_weight(None, [3, 1], device) is w
+
+    w = get_stream_weight(ListConfig([0.1, 0.9]), ListConfig([3, 1]))
+    assert torch.allclose(w, torch.tensor([0.1, 0.9]))
@@ -0,0 +1,22 @@
+"""Pack *-feats.npy files into a single archive for faster data loading
+"""
+import argparse
+import sys
+
+from nnsvs.logger import getLogger
+from nnsvs.train_util import pack_npy_files
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Pack *-feats.npy files into a single archive",
+    )
+    parser.add_argument("data_dirs", type=str, nargs="+", help="Feature dirs")
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args(sys.argv[1:])
+    logger = getLogger(verbose=1)
+    for data_dir in args.data_dirs:
+        pack_npy_files(data_dir, logger)